@@ -1,10 +1,15 @@
 import discord
 from discord import app_commands
-from discord.ext import tasks
 import os
 import asyncio
 import aiohttp
+import orjson
+from aiohttp import web
+from yarl import URL
+from web_server import health_check
+import random
 import time
+from dataclasses import dataclass
 from typing import Optional
 
 # --- Configuration & Setup ---
@@ -27,82 +32,182 @@ if not GEMINI_API_KEY:
 
 # --- Gemini API Service ---
 
+def jittered_backoff(attempt: int) -> float:
+    """Full-jitter exponential backoff: a random delay in [0, min(8, 2 ** attempt)] seconds."""
+    return random.uniform(0, min(8, 2 ** attempt))
+
+
+def retry_after_delay(headers, default: float) -> float:
+    """Returns the retry delay requested by the server's rate limit headers, or the default."""
+    for name in ('X-RateLimit-Reset-After', 'Retry-After'):
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                pass # Retry-After may also be an HTTP date; fall back to our own backoff
+    return default
+
+
 class GeminiService:
     """Handles asynchronous calls to the Gemini API for message generation."""
+    # Retry policy: statuses worth retrying, attempt cap, and total time budget per call
+    RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+    MAX_ATTEMPTS = 3
+    MAX_TOTAL_SECONDS = 60
+
     def __init__(self, api_key: str):
         self.api_key = api_key
-        # Using gemini-2.5-flash-preview-05-20 as the specified model
-        self.api_url = (
+        # Using gemini-2.5-flash-preview-05-20 as the specified model. The URL is parsed once here.
+        self._base_url = URL(
             "https://generativelanguage.googleapis.com/v1beta/models/"
-            "gemini-2.5-flash-preview-05-20:generateContent?key="
+            "gemini-2.5-flash-preview-05-20:generateContent"
         )
-
-    async def generate_content(self, prompt: str) -> str:
-        """Calls the Gemini API to get an AI-generated response."""
-        if not self.api_key:
-            return "Error: Gemini API key is missing. Cannot generate content."
-
-        url = f"{self.api_url}{self.api_key}"
-        
-        # System instruction to guide the bot's persona and output format
+        # System instruction to guide the bot's persona and output format.
+        # Built once and shared by every request payload.
         system_instruction = (
             "You are a friendly, concise, and helpful Discord channel announcer. "
             "Respond to the user's prompt by generating a short, engaging, and "
             "single-paragraph message for a Discord chat."
         )
+        self._system_part = {"parts": [{"text": system_instruction}]}
+        # The key travels in a header rather than the query string: aiohttp includes the
+        # request URL in some exception messages, which end up in logs and Discord
+        self._headers = {"Content-Type": "application/json", "x-goog-api-key": self.api_key or ""}
+        # Long-lived HTTP session, created lazily on the running event loop
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Caps concurrent Gemini calls so a retry storm can't open unbounded connections
+        self._sem = asyncio.Semaphore(4)
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Returns the shared session, (re)creating it if needed so keep-alive connections are reused."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=8, limit_per_host=4, ttl_dns_cache=300, keepalive_timeout=75
+                ),
+                timeout=aiohttp.ClientTimeout(total=20),
+            )
+        return self._session
+
+    async def close(self):
+        """Closes the shared HTTP session. Called on bot shutdown."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def generate_content(self, prompt: str) -> str:
+        """Calls the Gemini API to get an AI-generated response."""
+        if not self.api_key:
+            return "Error: Gemini API key is missing. Cannot generate content."
 
+        # Only the prompt changes between calls; the system instruction is prebuilt
         payload = {
-            "contents": [{"parts": [{"text: prompt}]}],
-            "systemInstruction": {"parts": [{"text": system_instruction}]},
+            "contents": [{"parts": [{"text": prompt}]}],
+            "systemInstruction": self._system_part,
         }
-
-        # Use aiohttp for asynchronous HTTP requests
-        async with aiohttp.ClientSession() as session:
+        body = orjson.dumps(payload)
+
+        # Reuse the shared aiohttp session so the TLS connection is kept alive between calls
+        session = await self._get_session()
+        # Bound the number of in-flight requests, matching the connector pool size per host
+        async with self._sem:
+            # Overall time budget for all attempts, so retries can't stall the scheduler
+            deadline = time.monotonic() + self.MAX_TOTAL_SECONDS
             try:
-                # Implementing basic exponential backoff for retries
-                for i in range(3): # Try up to 3 times
-                    async with session.post(url, json=payload, timeout=20) as response:
-                        if response.status == 200:
-                            result = await response.json()
-                            text = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', 'Failed to parse AI response.')
-                            return text
-                        elif response.status == 429:
-                            # Too Many Requests - apply backoff
-                            delay = 2 ** i
-                            print(f"API Rate Limit hit, retrying in {delay}s...")
-                            await asyncio.sleep(delay)
-                        else:
-                            error_text = await response.text()
-                            return f"AI API Error ({response.status}): {error_text}"
+                # Retry transient failures with jittered exponential backoff; fail fast on other 4xx
+                for i in range(self.MAX_ATTEMPTS):
+                    timeout = aiohttp.ClientTimeout(total=min(20, deadline - time.monotonic()))
+                    try:
+                        async with session.post(self._base_url, data=body, headers=self._headers, timeout=timeout) as response:
+                            status = response.status
+                            if status == 200:
+                                raw = await response.read()
+                                result = orjson.loads(raw)
+                                try:
+                                    return result['candidates'][0]['content']['parts'][0]['text']
+                                except (KeyError, IndexError, TypeError):
+                                    return 'Failed to parse AI response.'
+                            elif status not in self.RETRYABLE_STATUSES:
+                                # Only the start of the error body is useful in a Discord message;
+                                # close the connection instead of draining the rest
+                                error_text = (await response.content.read(512)).decode(errors='replace')
+                                response.close()
+                                return f"AI API Error ({status}): {error_text}"
+                            # Rate limited or transient server error - apply backoff.
+                            # The body is never read here; the status and headers are enough.
+                            delay = retry_after_delay(response.headers, jittered_backoff(i))
+                            reason = f"AI API returned {status}"
+                    except aiohttp.ClientSSLError as e:
+                        # TLS/certificate failures won't fix themselves; fail fast like other hard errors
+                        return f"Network or API communication error: {type(e).__name__}"
+                    except (aiohttp.ClientConnectorError, aiohttp.ServerDisconnectedError, asyncio.TimeoutError) as e:
+                        # Only the exception type is reported: the message can embed the request URL,
+                        # and this text is printed and may be posted to the Discord channel
+                        if i == self.MAX_ATTEMPTS - 1:
+                            return f"Network or API communication error: {type(e).__name__}"
+                        delay = jittered_backoff(i)
+                        reason = f"AI API connection failed ({type(e).__name__})"
+
+                    # Don't sleep after the final attempt or past the time budget
+                    if i == self.MAX_ATTEMPTS - 1 or time.monotonic() + delay >= deadline:
+                        break
+                    print(f"{reason}, retrying in {delay:.1f}s...")
+                    await asyncio.sleep(delay)
                 return "AI API failed after multiple retries due to rate limiting or server issues."
             except aiohttp.ClientError as e:
                 return f"Network or API communication error: {e}"
             except Exception as e:
                 return f"An unexpected error occurred during AI generation: {e}"
 
-
 # --- Discord Bot Implementation ---
 
+@dataclass(slots=True)
+class Schedule:
+    """The state of the scheduled message, kept in one slotted object instead of loose bot attributes."""
+    interval_seconds: Optional[int] = None
+    channel_id: Optional[int] = None
+    message_content: Optional[str] = None
+    ai_prompt: Optional[str] = None
+    mode: Optional[str] = None # 'manual' or 'automatic'
+
+    # Anti-Stacking/Activity Tracking variables
+    # Both are time.monotonic() readings, so wall-clock adjustments can't skew the interval math.
+    # -inf means "never sent", which makes the first send due immediately.
+    last_bot_send_time: float = float('-inf') # When the bot last sent the scheduled message
+    last_channel_activity_time: float = float('-inf') # When anyone last sent a message in the channel
+
+
 class ScheduledMessageBot(discord.Client):
     def __init__(self, *, intents: discord.Intents):
         super().__init__(intents=intents)
         self.tree = app_commands.CommandTree(self)
 
-        # Scheduling configuration (stores the state of the scheduled message)
-        self.scheduled_task = None
-        self.interval_seconds: Optional[int] = None
-        self.channel_id: Optional[int] = None
-        self.message_content: Optional[str] = None
-        self.ai_prompt: Optional[str] = None
-        self.mode: Optional[str] = None # 'manual' or 'automatic'
-        
-        # Anti-Stacking/Activity Tracking variables
-        self.last_bot_send_time: float = 0.0 # Unix timestamp of when the bot last sent the scheduled message
-        self.last_channel_activity_time: float = time.time() # Unix timestamp of the last message sent by anyone in the channel
+        # Scheduling configuration and anti-stacking state (see Schedule)
+        self.schedule = Schedule(last_channel_activity_time=time.monotonic())
+        self._scheduler_task: Optional[asyncio.Task] = None
+        self._config_changed = asyncio.Event() # Set by the slash commands to wake the scheduler
+        self._activity_event = asyncio.Event() # Set by _handle_message_sync when the channel becomes active again
 
         # Initialize AI service
         self.gemini_service = GeminiService(GEMINI_API_KEY)
 
+        # Keep-alive web server runner (started in setup_hook on the bot's event loop)
+        self._web_runner: Optional[web.AppRunner] = None
+
+
+    async def setup_hook(self):
+        """Registers the slash commands and starts the keep-alive health check endpoint on the bot's own event loop."""
+        self._register_commands()
+
+        app = web.Application()
+        app.router.add_get('/', health_check)
+        self._web_runner = web.AppRunner(app)
+        await self._web_runner.setup()
+        # Railway assigns the port dynamically through the PORT environment variable
+        port = int(os.getenv('PORT', 8080))
+        await web.TCPSite(self._web_runner, '0.0.0.0', port).start()
+        print(f"Keep-Alive Web Server started on port {port}.")
+
 
     async def on_ready(self):
         """Called when the bot successfully connects to Discord."""
@@ -110,77 +215,168 @@ class ScheduledMessageBot(discord.Client):
         print(f'Logged in as {self.user} (ID: {self.user.id})')
         print('Ready to receive commands.')
 
-        # Start the background loop when the bot is ready
-        if self.scheduled_task is None or not self.scheduled_task.is_running():
-            # The loop is started once and runs forever, checking the schedule and state every 60s.
-            self.scheduled_task = self.send_scheduled_message.start()
-
+        # Start the scheduler when the bot is ready (on_ready also fires on reconnects)
+        if self._scheduler_task is None or self._scheduler_task.done():
+            # This is the only place the coroutine is started; it runs forever, sleeping until the
+            # next send is due, and the slash commands only replace self.schedule and wake it.
+            self._scheduler_task = asyncio.create_task(self._scheduler_coro(), name="stellar-scheduler")
+
+
+    async def close(self):
+        """Stops the scheduler and releases the HTTP session and web server before disconnecting from Discord."""
+        if self._scheduler_task is not None:
+            self._scheduler_task.cancel()
+            await asyncio.gather(self._scheduler_task, return_exceptions=True)
+        await self.gemini_service.close()
+        if self._web_runner is not None:
+            await self._web_runner.cleanup()
+        await super().close()
+
+
+    def dispatch(self, event: str, /, *args, **kwargs) -> None:
+        """Handles gateway messages synchronously instead of scheduling an on_message Task for each."""
+        if event == 'message':
+            self._handle_message_sync(args[0])
+        super().dispatch(event, *args, **kwargs)
+
+
+    def _handle_message_sync(self, message: discord.Message):
+        """Updates the last channel activity time. Deliberately not a coroutine (see dispatch)."""
+        # We only care about activity in the *scheduled* channel to track silence,
+        # so bail out first on the common "no schedule / other channel" case
+        cid = self.schedule.channel_id
+        if cid is None or message.channel.id != cid:
+            return
 
-    async def on_message(self, message: discord.Message):
-        """Updates the last channel activity time."""
-        # Ignore messages sent by the bot itself or system messages
-        if message.author == self.user or message.author.bot:
+        # Ignore messages sent by bots (including this one)
+        if message.author.bot:
             return
 
-        # We only care about activity in the *scheduled* channel to track silence
-        if self.channel_id is not None and message.channel.id == self.channel_id:
-            self.last_channel_activity_time = time.time()
-            
+        # A fresh monotonic reading is always later than the last send, so this
+        # is always activity since that send: wake the scheduler if it is waiting
+        self.schedule.last_channel_activity_time = time.monotonic()
+        self._activity_event.set()
+
     
-    @tasks.loop(seconds=60) # Check every 60 seconds
-    async def send_scheduled_message(self):
-        """The core background task that implements the scheduling and anti-stacking logic."""
-        if self.channel_id is None or self.interval_seconds is None:
-            return # Task is running but no schedule is set
-
-        # 1. Check if the required time interval has passed since the last successful send
-        time_since_last_send = time.time() - self.last_bot_send_time
-        if time_since_last_send < self.interval_seconds:
-            return
+    async def _scheduler_coro(self):
+        """The core background task: sleeps until the next send is due instead of polling."""
+        while not self.is_closed():
+            now = time.monotonic() # Sampled once per tick
+            schedule = self.schedule
+            if schedule.channel_id is None or schedule.interval_seconds is None:
+                # No schedule is set; sleep until a slash command configures one
+                await self._wait_for_config_change()
+                continue
+
+            # 1. Sleep until the required time interval has passed since the last successful send
+            next_fire = schedule.last_bot_send_time + schedule.interval_seconds
+            delay = next_fire - now
+            if delay > 0 and await self._wait_for_config_change(delay):
+                continue # Schedule changed while sleeping; recompute the deadline
+
+            # 2. If the channel has been quiet since the last send, sleep until _handle_message_sync
+            # reports activity rather than re-checking on a timer
+            if schedule.last_channel_activity_time <= schedule.last_bot_send_time:
+                try:
+                    await asyncio.wait_for(self._activity_event.wait(), schedule.interval_seconds)
+                    self._activity_event.clear() # Consumed; cleared only after waking so no set() is lost
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if not await self.send_scheduled_message():
+                # The send failed or the schedule was replaced mid-send; check again in a minute
+                # (a replacement has already set _config_changed, so that wait returns at once)
+                await self._wait_for_config_change(60)
+
+
+    async def _wait_for_config_change(self, timeout: Optional[float] = None) -> bool:
+        """Waits until the schedule is reconfigured or the timeout expires. Returns True if it changed."""
+        try:
+            await asyncio.wait_for(self._config_changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        # Cleared only once consumed, so a reconfiguration that lands mid-send isn't lost
+        self._config_changed.clear()
+        return True
+
+
+    async def send_scheduled_message(self) -> bool:
+        """Implements the anti-stacking check and sends the scheduled message. Returns True if sent."""
+        # Pin the schedule this send belongs to; /manual and /automatic replace self.schedule
+        # with a new object, which may happen while the AI reply is being generated
+        schedule = self.schedule
 
         # 2. Implement the Anti-Stacking/Activity Check
         # If the last channel activity was at or before the bot's last send time, 
         # it means the channel has been quiet since the last scheduled message. Skip sending.
-        if self.last_channel_activity_time <= self.last_bot_send_time:
+        if schedule.last_channel_activity_time <= schedule.last_bot_send_time:
             # print("Channel is quiet. Skipping send to prevent spam.")
-            return
+            return False
 
         # 3. Time has passed AND channel has been active. Proceed to send.
         
-        target_channel = self.get_channel(self.channel_id)
+        target_channel = self.get_channel(schedule.channel_id)
         if not target_channel:
-            print(f"Error: Scheduled channel with ID {self.channel_id} not found.")
-            return
+            print(f"Error: Scheduled channel with ID {schedule.channel_id} not found.")
+            return False
 
-        message_to_send = self.message_content
+        message_to_send = schedule.message_content
 
         # If in automatic mode, generate content first
-        if self.mode == 'automatic' and self.ai_prompt:
+        if schedule.mode == 'automatic' and schedule.ai_prompt:
             if not GEMINI_API_KEY:
                 print("Skipping automatic message generation: GEMINI_API_KEY is missing.")
                 message_to_send = "Automatic message generation failed: API Key missing."
             else:
                 # AI generation is the new message to send
-                message_to_send = await self.gemini_service.generate_content(self.ai_prompt)
+                message_to_send = await self.gemini_service.generate_content(schedule.ai_prompt)
         
+        # The schedule was replaced while generating; drop this stale message and let the
+        # scheduler pick up the new configuration instead
+        if self.schedule is not schedule:
+            return False
+
         # 4. Send the message
         try:
             await target_channel.send(message_to_send)
-            # Update the bot's last send time immediately after successful send
-            self.last_bot_send_time = time.time()
-            print(f"Scheduled message ({self.mode} mode) sent successfully.")
+            # Update the bot's last send time immediately after successful send. This is sampled
+            # after the send (not at the top of the tick) so messages posted while the AI reply
+            # was being generated aren't counted as activity since this send.
+            schedule.last_bot_send_time = time.monotonic()
+            print(f"Scheduled message ({schedule.mode} mode) sent successfully.")
+            return True
         except discord.Forbidden:
             print(f"Error: Bot does not have permission to send messages in channel {target_channel.name}.")
         except Exception as e:
             print(f"An error occurred while sending the message: {e}")
+        return False
 
     # --- Slash Commands ---
 
-    @app_commands.command(name="manual", description="Schedule a single message to be sent repeatedly.")
-    @app_commands.describe(
-        message="The message to send repeatedly.",
-        interval_hours="The interval in hours between messages (must be >= 1).",
-    )
+    def _register_commands(self):
+        """Adds the slash commands to self.tree so that tree.sync() publishes them.
+
+        app_commands.command on a discord.Client method never reaches the tree (only Cogs
+        collect decorated methods), so thin closures delegating to the methods are registered.
+        """
+        @self.tree.command(name="manual", description="Schedule a single message to be sent repeatedly.")
+        @app_commands.describe(
+            message="The message to send repeatedly.",
+            interval_hours="The interval in hours between messages (must be >= 1).",
+        )
+        async def manual(interaction: discord.Interaction, message: str, interval_hours: int):
+            await self.manual(interaction, message, interval_hours)
+
+        @self.tree.command(name="automatic", description="Schedule an AI-generated message to be sent repeatedly.")
+        @app_commands.describe(
+            prompt="The prompt the AI uses to generate each message.",
+            interval_hours="The interval in hours between messages (must be >= 1).",
+        )
+        async def automatic(interaction: discord.Interaction, prompt: str, interval_hours: int):
+            await self.automatic(interaction, prompt, interval_hours)
+
+
     async def manual(self, interaction: discord.Interaction, message: str, interval_hours: int):
         await interaction.response.defer(ephemeral=True, thinking=True)
 
@@ -191,26 +387,74 @@ class ScheduledMessageBot(discord.Client):
         # Convert hours to seconds for the internal timer
         interval_seconds = interval_hours * 3600
 
-        # Stop existing task if running (though the loop runs, canceling ensures a state reset)
-        if self.scheduled_task is not None and self.scheduled_task.is_running():
-            self.scheduled_task.cancel()
-        
-        # Set new configuration
-        self.mode = 'manual'
-        self.message_content = message
-        self.ai_prompt = None # Clear AI prompt
-        self.interval_seconds = interval_seconds
-        self.channel_id = interaction.channel_id
-        self.last_bot_send_time = 0.0 # Reset timer to allow for immediate send check
-        self.last_channel_activity_time = time.time() # Assume channel is active since command was just sent
-
-        # Restart the task loop (it handles starting/restarting itself in on_ready, but we re-start it here too)
-        self.scheduled_task = self.send_scheduled_message.start()
+        # Set new configuration (the running scheduler picks it up; no task restart needed).
+        # A fresh Schedule is assigned rather than mutating the old one, so a send already in
+        # flight for the old configuration can't stamp or overwrite the new one.
+        # last_bot_send_time defaults to -inf, allowing an immediate send check.
+        self.schedule = Schedule(
+            mode='manual',
+            message_content=message,
+            interval_seconds=interval_seconds,
+            channel_id=interaction.channel_id,
+            last_channel_activity_time=time.monotonic(), # Assume channel is active since command was just sent
+        )
+
+        # Wake the scheduler so it recomputes its deadline from the new configuration
+        self._config_changed.set()
+        self._activity_event.set()
 
         await interaction.followup.send(
             f"**Manual Schedule Set!**\n"
-            f"The following message will be sent in <#{self.channel_id}> "
+            f"The following message will be sent in <#{interaction.channel_id}> "
             f"every **{interval_hours} hour(s)**, but only if there has been "
             f"activity in the channel since the last scheduled message was sent:\n"
-            f"
-      
+            f"> {message}",
+            ephemeral=True,
+        )
+
+
+    async def automatic(self, interaction: discord.Interaction, prompt: str, interval_hours: int):
+        await interaction.response.defer(ephemeral=True, thinking=True)
+
+        if interval_hours < 1:
+            await interaction.followup.send("The interval must be 1 hour or more.", ephemeral=True)
+            return
+
+        if not GEMINI_API_KEY:
+            await interaction.followup.send(
+                "Automatic mode is unavailable: GEMINI_API_KEY is not configured.", ephemeral=True
+            )
+            return
+
+        # Convert hours to seconds for the internal timer
+        interval_seconds = interval_hours * 3600
+
+        # Set new configuration (see manual for why a fresh Schedule is assigned).
+        # Content is generated at send time, so message_content stays unset.
+        self.schedule = Schedule(
+            mode='automatic',
+            ai_prompt=prompt,
+            interval_seconds=interval_seconds,
+            channel_id=interaction.channel_id,
+            last_channel_activity_time=time.monotonic(), # Assume channel is active since command was just sent
+        )
+
+        # Wake the scheduler so it recomputes its deadline from the new configuration
+        self._config_changed.set()
+        self._activity_event.set()
+
+        await interaction.followup.send(
+            f"**Automatic Schedule Set!**\n"
+            f"An AI-generated message will be sent in <#{interaction.channel_id}> "
+            f"every **{interval_hours} hour(s)**, but only if there has been "
+            f"activity in the channel since the last scheduled message was sent, using the prompt:\n"
+            f"> {prompt}",
+            ephemeral=True,
+        )
+
+
+# --- Entry Point ---
+
+if __name__ == '__main__':
+    client = ScheduledMessageBot(intents=discord.Intents.default())
+    client.run(DISCORD_BOT_TOKEN)